@@ -6,6 +6,7 @@ index = {"Config": "00_learner.ipynb",
          "Learner.apply_dropout": "00_learner.ipynb",
          "energy_max": "00_learner.ipynb",
          "Learner.predict_tiles": "00_learner.ipynb",
+         "save_tmp_iter": "00_learner.ipynb",
          "save_tmp": "00_learner.ipynb",
          "EnsembleLearner": "00_learner.ipynb",
          "UNetConvBlock": "01_models.ipynb",
@@ -24,9 +25,15 @@ index = {"Config": "00_learner.ipynb",
          "show": "02_data.ipynb",
          "calculate_weights": "02_data.ipynb",
          "DeformationField": "02_data.ipynb",
+         "DeformationFieldBank": "02_data.ipynb",
+         "ImageCache": "02_data.ipynb",
          "BaseDataset": "02_data.ipynb",
          "RandomTileDataset": "02_data.ipynb",
+         "BatchDeformation": "02_data.ipynb",
+         "ScaleNormalize": "02_data.ipynb",
+         "ToUnitRange": "02_data.ipynb",
          "TileDataset": "02_data.ipynb",
+         "TileStitcher": "02_data.ipynb",
          "Dice_f1": "03_metrics.ipynb",
          "Iou": "03_metrics.ipynb",
          "Recorder.plot_metrics": "03_metrics.ipynb",
@@ -54,6 +61,7 @@ index = {"Config": "00_learner.ipynb",
          "Transformer": "07_tta.ipynb",
          "Compose": "07_tta.ipynb",
          "Merger": "07_tta.ipynb",
+         "OnlineMerger": "07_tta.ipynb",
          "HorizontalFlip": "07_tta.ipynb",
          "VerticalFlip": "07_tta.ipynb",
          "Rotate90": "07_tta.ipynb",
@@ -1,17 +1,25 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_data.ipynb (unless otherwise specified).
 
-__all__ = ['show', 'calculate_weights', 'DeformationField', 'BaseDataset', 'RandomTileDataset', 'TileDataset']
+__all__ = ['show', 'calculate_weights', 'DeformationField', 'DeformationFieldBank', 'ImageCache', 'BaseDataset',
+           'RandomTileDataset', 'BatchDeformation', 'ScaleNormalize', 'ToUnitRange', 'TileDataset', 'TileStitcher']
 
 # Cell
 import os
+import hashlib
+import json
 import numpy as np
 import imageio
 import shutil
-from joblib import Parallel, delayed
+from copy import copy
+import tempfile
+import weakref
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed, effective_n_jobs
 
 from scipy import ndimage
 from scipy.interpolate import Rbf
-from scipy.interpolate import interp1d
 
 from matplotlib.patches import Rectangle
 from skimage.measure import label, regionprops
@@ -134,29 +142,85 @@ def show_results(x:TensorImage, y:tuple, samples, outs, max_n=4, figsize=None, *
     for i in range(max_n): show(x[i], y[0][i], outs[i][0], pred=True, figsize=figsize, **kwargs)
 
 # Cell
-def calculate_weights(clabels=None, instlabels=None, ignore=None,
-                      n_dims = 2, bws=10, fds=10, bwf=10, fbr=.1):
-    """
-    Calculates the weights from the given mask (classlabels `clabels` or `instlabels`).
-    """
-
-    assert not (clabels is None and instlabels is None), "Provide either clabels or instlabels"
-
+# exp(-x) with x > 104 is below the smallest float32 number and does not change the weights,
+# the approximate mode truncates the gaussians at 5 sigma (x > 12.5)
+_EXP_CUTOFF = {'exact': 104., 'approx': 12.5}
+
+def _max_dist(sigma, mode='exact'):
+    "Distance beyond which a gaussian with `sigma` does not contribute to the weights."
+    return np.sqrt(2*_EXP_CUTOFF[mode])*sigma
+
+def _instance_distances_full(instlabels, instances, min1dist, min2dist, frgrd_dist, fds=10, **kwargs):
+    "Updates nearest distances with one full-image distance transform per instance."
+    for instance in instances:
+        dt = ndimage.morphology.distance_transform_edt(instlabels != instance)
+        frgrd_dist += np.exp(-dt ** 2 / (2*fds ** 2))
+        min2dist = np.minimum(min2dist, dt)
+        newMin1 = np.minimum(min1dist, min2dist)
+        newMin2 = np.maximum(min1dist, min2dist)
+        min1dist = newMin1
+        min2dist = newMin2
+    return min1dist, min2dist
+
+def _instance_distances_local(instlabels, instances, min1dist, min2dist, frgrd_dist, fds=10, bws=10, mode='exact'):
+    "Updates nearest distances with distance transforms restricted to the padded bounding box of each instance."
+    # Pixels outside the padded box are too far away to contribute to the weights
+    pad = int(np.ceil(_max_dist(max(bws, fds), mode)))
+    objects = ndimage.find_objects(instlabels)
+    for instance in instances:
+        sl = tuple(slice(max(s.start-pad, 0), s.stop+pad) for s in objects[int(instance)-1])
+        dt = ndimage.morphology.distance_transform_edt(instlabels[sl] != instance)
+        frgrd_dist[sl] += np.exp(-dt ** 2 / (2*fds ** 2))
+        min2dist[sl] = np.minimum(min2dist[sl], dt)
+        newMin1 = np.minimum(min1dist[sl], min2dist[sl])
+        min2dist[sl] = np.maximum(min1dist[sl], min2dist[sl])
+        min1dist[sl] = newMin1
+    return min1dist, min2dist
+
+def _instance_ridges(instlabels, instances, n_dims=2):
+    "Mask of instance pixels that remain after removing the ridges between touching `instances`."
+    # Equivalent to adding the instances one by one in ascending order and dropping pixels
+    # that touch an already added instance. Pixels only depend on lower instances,
+    # hence their state is resolved within a few whole-image passes.
+    footprint = np.ones((3,) * n_dims)
+    inst = np.where(np.isin(instlabels, instances), instlabels, 0).astype(int)
+    fg = inst > 0
+    bg_val = inst.max() + 1
+    def _touches_lower(m):
+        lower = ndimage.minimum_filter(np.where(m, inst, bg_val), footprint=footprint, mode='constant', cval=bg_val)
+        return lower < inst
+    kept = fg & ~_touches_lower(fg)
+    undecided = fg & ~kept
+    while undecided.any():
+        removed = undecided & _touches_lower(kept)
+        added = undecided & ~_touches_lower(kept | undecided)
+        kept |= added
+        undecided &= ~(removed | added)
+    return kept
+
+_weight_engines = {
+    'full' : _instance_distances_full,
+    'local' : _instance_distances_local,
+}
+
+def _distance_maps(clabels=None, instlabels=None, n_dims=2, bws=10, fds=10, engine='local', mode='exact'):
+    "Computes labels with ridges, nearest instance distances per class, and the foreground distance term."
     # If no classlabels are given treat the problem as binary segmentation
     # ==> Create a new array assigning class 1 (foreground) to each instance
     if clabels is None:
         clabels = (instlabels > 0).astype(int)
 
-    # Initialize label and weights arrays with background
+    # Initialize label and distance arrays with background
     labels = np.zeros_like(clabels)
-    wghts = fbr * np.ones_like(clabels)
+    min_dists = []
     frgrd_dist = np.zeros_like(clabels, dtype='float32')
     classes = np.unique(clabels)[1:]
 
     # If no instance labels are given, generate them now
     if instlabels is None:
         # Creating instance labels from mask
-        instlabels = np.zeros_like(clabels)
+        # int32 instance ids, class masks are uint8 and would wrap after 255 instances
+        instlabels = np.zeros(clabels.shape, dtype=np.int32)
         nextInstance = 1
         for c in classes:
             comps, nInstances = ndimage.measurements.label(clabels == c)
@@ -169,23 +233,21 @@ def calculate_weights(clabels=None, instlabels=None, ignore=None,
 
         # Generate background ridges between touching instances
         # of that class, avoid overlapping instances
-        for instance in instances:
-            objectMaskDil = ndimage.morphology.binary_dilation(
-                labels == c, structure=np.ones((3,) * n_dims))
-            labels[(instlabels == instance) & (objectMaskDil == 0)] = c
+        labels[_instance_ridges(instlabels, instances, n_dims)] = c
 
-        # Generate weights
+        # Distances to the closest and second closest instance
         min1dist = 1e10 * np.ones(labels.shape)
         min2dist = 1e10 * np.ones(labels.shape)
-        for instance in instances:
-            dt = ndimage.morphology.distance_transform_edt(instlabels != instance)
-
-            frgrd_dist += np.exp(-dt ** 2 / (2*fds ** 2))
-            min2dist = np.minimum(min2dist, dt)
-            newMin1 = np.minimum(min1dist, min2dist)
-            newMin2 = np.maximum(min1dist, min2dist)
-            min1dist = newMin1
-            min2dist = newMin2
+        min_dists.append(_weight_engines[engine](instlabels, instances, min1dist, min2dist,
+                                                 frgrd_dist, fds=fds, bws=bws, mode=mode))
+
+    max_dist = np.inf if engine=='full' else _max_dist(max(bws, fds), mode)
+    return labels, min_dists, frgrd_dist, max_dist
+
+def _weights_from_distance_maps(labels, min_dists, frgrd_dist, ignore=None, bws=10, bwf=10, fbr=.1):
+    "Calculates weights and pdf from the output of `_distance_maps`."
+    wghts = fbr * np.ones_like(labels)
+    for min1dist, min2dist in min_dists:
         wghts += bwf * np.exp(
             -(min1dist + min2dist) ** 2 / (2*bws ** 2))
 
@@ -204,12 +266,98 @@ def calculate_weights(clabels=None, instlabels=None, ignore=None,
             wghts.astype(np.float32),
             pdf.astype(np.float32))
 
+def _mask_hash(*arrays):
+    "Hashes the content of masks to identify cached data."
+    h = hashlib.md5()
+    for a in arrays:
+        if a is None:
+            h.update(b'None')
+            continue
+        a = np.ascontiguousarray(a)
+        h.update(f'{a.dtype}{a.shape}'.encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+# Squared distances are integers and stored lossless, 1e10 (no instance) is stored as maximum value
+_NO_DIST = np.iinfo(np.uint32).max
+
+def _save_npz(path, **arrays):
+    "Writes uncompressed `arrays` to `path` through a temporary file, readers never see partial files."
+    tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npz')
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def _cached_distance_maps(cache_dir, clabels=None, instlabels=None, n_dims=2, bws=10, fds=10, engine='local', mode='exact'):
+    "Loads `_distance_maps` from `cache_dir` (keyed by mask content) or computes and saves them."
+    key = _mask_hash(clabels, instlabels, n_dims)
+    dist_path = cache_dir/f'{key}_dist.npz'
+    frgrd_path = cache_dir/f'{key}_fds_{fds}.npz'
+    try:
+        with open(dist_path, 'rb') as f:
+            tmp = np.load(f)
+            labels, sq_dists, max_dist = tmp['lbl'], tmp['sq_dists'], tmp['max_dist']
+        with open(frgrd_path, 'rb') as f:
+            tmp = np.load(f)
+            frgrd_dist, frgrd_max_dist = tmp['frgrd'], tmp['max_dist']
+        assert _max_dist(bws, mode) <= max_dist, 'Cached distances do not cover bws'
+        assert _max_dist(fds, mode) <= frgrd_max_dist, 'Cached distances do not cover fds'
+        min_dists = [np.where(sq==_NO_DIST, 1e10, np.sqrt(sq)) for sq in sq_dists.reshape(-1, *labels.shape)]
+        return labels, list(zip(min_dists[::2], min_dists[1::2])), frgrd_dist
+    except (OSError, KeyError, ValueError, AssertionError):
+        labels, min_dists, frgrd_dist, max_dist = _distance_maps(clabels, instlabels, n_dims, bws, fds, engine, mode)
+        sq_dists = np.array([np.minimum(np.round(d**2), _NO_DIST) for d in sum(min_dists, ())], dtype=np.uint32)
+        cache_dir.mkdir(exist_ok=True, parents=True)
+        _save_npz(dist_path, lbl=labels, sq_dists=sq_dists, max_dist=max_dist)
+        _save_npz(frgrd_path, frgrd=frgrd_dist, max_dist=max_dist)
+        return labels, min_dists, frgrd_dist
+
+# Cell
+def calculate_weights(clabels=None, instlabels=None, ignore=None,
+                      n_dims = 2, bws=10, fds=10, bwf=10, fbr=.1, engine='local', mode='exact', cache_dir=None):
+    """
+    Calculates the weights from the given mask (classlabels `clabels` or `instlabels`).
+    """
+
+    assert not (clabels is None and instlabels is None), "Provide either clabels or instlabels"
+    assert engine in _weight_engines, f"Select one of {list(_weight_engines)} as engine"
+    assert mode in _EXP_CUTOFF, f"Select one of {list(_EXP_CUTOFF)} as mode"
+
+    if cache_dir is None:
+        labels, min_dists, frgrd_dist, _ = _distance_maps(clabels, instlabels, n_dims, bws, fds, engine, mode)
+    else:
+        labels, min_dists, frgrd_dist = _cached_distance_maps(Path(cache_dir), clabels, instlabels,
+                                                              n_dims, bws, fds, engine, mode)
+
+    return _weights_from_distance_maps(labels, min_dists, frgrd_dist, ignore, bws, bwf, fbr)
+
 # Cell
+def _seed_positions(n, g):
+    "Positions of deformation seeds spaced `g` apart (starting at -g/2) that enclose all `n` pixels, so no pixel is extrapolated."
+    return np.arange(-g / 2, n - 1 + g, g)
+
+def _bspline_matrix(n_seeds, n_out, g):
+    "Interpolation matrix for cubic B-spline upsampling of `n_seeds` points spaced `g` apart (starting at -g/2) to `n_out` points, passing through the seeds."
+    pos = (np.arange(n_out) + g / 2) / g
+    return np.stack([ndimage.map_coordinates(e, [pos], order=3, mode='mirror') for e in np.eye(n_seeds)], axis=1)
+
+def _bspline_deformation(shape, grid=(150, 150), sigma=(10, 10), rng=np.random):
+    "Random smooth displacements with `shape` from normal distributed seeds on a grid, separable cubic B-spline upsampling."
+    # Axes are ordered like `np.meshgrid` (first two dimensions swapped)
+    perm = [1, 0, *range(2, len(shape))]
+    mats = [_bspline_matrix(len(_seed_positions(shape[a], grid[p])), shape[a], grid[p])
+            for a, p in enumerate(perm)]
+    deformation = []
+    for s in sigma:
+        d = rng.normal(0, s, [m.shape[1] for m in mats])
+        for a, m in enumerate(mats): d = np.moveaxis(np.tensordot(m, d, axes=(1, a)), 0, a)
+        deformation.append(d.astype('float32'))
+    return deformation
+
 class DeformationField:
     "Creates a deformation field for data augmentation"
     def __init__(self, shape=(540, 540)):
         self.shape = shape
-        self.deformationField = np.meshgrid(*[np.arange(d) - d / 2 for d in shape])[::-1]
+        self.deformationField = np.meshgrid(*[np.arange(d, dtype='float32') - d / 2 for d in shape])[::-1]
 
     def rotate(self, theta=0, phi=0, psi=0):
         "Rotate deformation field"
@@ -249,15 +397,18 @@ class DeformationField:
             if dims[d]:
                 self.deformationField[d] = -self.deformationField[d]
 
-    def addRandomDeformation(self, grid=(150, 150), sigma=(10, 10)):
+    def addRandomDeformation(self, grid=(150, 150), sigma=(10, 10), method='bspline', rng=np.random):
         "Add random deformation to the deformation field"
-        seedGrid = np.meshgrid(
-            *[np.arange(-g / 2, s + g / 2, g) for (g, s) in zip(grid, self.shape)]
-        )
-        seed = [np.random.normal(0, s, g.shape) for (g, s) in zip(seedGrid, sigma)]
-        defFcn = [Rbf(*seedGrid, s, function="cubic") for s in seed]
-        targetGrid = np.meshgrid(*map(np.arange, self.shape))
-        deformation = [f(*targetGrid) for f in defFcn]
+        if method=='rbf':
+            seedGrid = np.meshgrid(
+                *[_seed_positions(s, g) for (g, s) in zip(grid, self.shape)]
+            )
+            seed = [rng.normal(0, s, g.shape) for (g, s) in zip(seedGrid, sigma)]
+            defFcn = [Rbf(*seedGrid, s, function="cubic") for s in seed]
+            targetGrid = np.meshgrid(*map(np.arange, self.shape))
+            deformation = [f(*targetGrid).astype('float32') for f in defFcn]
+        else:
+            deformation = _bspline_deformation(self.deformationField[0].shape, grid, sigma, rng)
         self.deformationField = [
             f + df for (f, df) in zip(self.deformationField, deformation)
         ]
@@ -287,15 +438,80 @@ class DeformationField:
                 .astype(data.dtype))
 
 # Cell
-def _read_img(path, divide=None, **kwargs):
-    "Read image and normalize to 0-1 range"
+def _refill_bank(create_ref, q, rng, stop):
+    "Puts new fields into `q` until `stop` is set or the function behind the weak reference `create_ref` is garbage collected"
+    while not stop.is_set():
+        fn = create_ref()
+        if fn is None: return
+        field = fn(rng)
+        del fn
+        while not stop.is_set():
+            try:
+                q.put(field, timeout=.1)
+                break
+            except queue.Full: pass
+
+class DeformationFieldBank:
+    "Ring buffer of `n` deformation fields created by `create_fn(rng)`, refilled in a background thread with its own seeded generator"
+    def __init__(self, create_fn, n=16, queue_size=4, seed=None):
+        store_attr('create_fn, n, queue_size')
+        self.seed = seed if seed is not None else np.random.randint(2**31)
+        rng = np.random.RandomState([self.seed, 0, 0, 0])
+        self.fields = [create_fn(rng) for _ in range(n)]
+        self.pos, self.epoch = 0, 0
+        self._pid = None
+
+    def _start(self):
+        "Starts the refill thread (once per process, e.g. in each dataloader worker, and epoch)"
+        worker_info = torch.utils.data.get_worker_info()
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.queue_size)
+        self._stop = threading.Event()
+        rng = np.random.RandomState([self.seed, self.epoch, worker_info.id+1 if worker_info is not None else 0, 1])
+        # The thread only holds a weak reference and does not keep the bank (or its dataset) alive
+        create_ref = weakref.WeakMethod(self.create_fn) if hasattr(self.create_fn, '__self__') else weakref.ref(self.create_fn)
+        self._thread = threading.Thread(target=_refill_bank, args=(create_ref, self._queue, rng, self._stop), daemon=True)
+        self._thread.start()
+        self._finalizer = weakref.finalize(self, self._stop.set)
+
+    def stop(self):
+        "Stops the refill thread of this process"
+        if self._pid == os.getpid():
+            self._stop.set()
+            self._finalizer.detach()
+        self._pid = None
+
+    def set_epoch(self, epoch):
+        "Reseeds a running refill thread for `epoch`"
+        self.epoch = epoch
+        if self._pid == os.getpid():
+            self.stop()
+            self._start()
+
+    def draw(self, rng=np.random):
+        "Replaces the oldest field with a new one if available and returns a random field"
+        if self._pid != os.getpid(): self._start()
+        try:
+            self.fields[self.pos] = self._queue.get_nowait()
+            self.pos = (self.pos + 1) % self.n
+        except queue.Empty: pass
+        return self.fields[rng.randint(self.n)]
+
+    def __getstate__(self):
+        return {k:v for k,v in self.__dict__.items() if k not in ['_pid', '_queue', '_stop', '_thread', '_finalizer']}
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._pid = None
+
+# Cell
+def _read_img(path, divide=None, projection='max', native=False, **kwargs):
+    "Read image and normalize to 0-1 range (or keep its `native` dtype), zarr stacks are projected along z"
     if path.suffix == '.zarr':
-        zarr = import_package('zarr')
-        img = zarr.convenience.load(str(path)) # assuming shape (z_dim, n_channel, y_dim, x_dim)
-        img = np.max(img, axis=0) # max z projection
-        img = np.moveaxis(img, 0, -1)
+        img = _RegionReader(path, projection=projection)[:, :]
     else:
         img = imageio.imread(path, **kwargs)
+        if native: return img if img.ndim == 3 else np.expand_dims(img, axis=2)
         if divide is None and img.max()>0:
             img = img/np.iinfo(img.dtype).max
         if divide is not None:
@@ -306,6 +522,204 @@ def _read_img(path, divide=None, **kwargs):
             img = np.expand_dims(img, axis=2)
     return img
 
+def _img_scale(dtype, divide=None):
+    "Factor that maps image values of `dtype` to the 0-1 range as in `_read_img`"
+    if divide is not None: return 1/divide
+    return 1/np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1.
+
+# Cell
+@functools.lru_cache(maxsize=None)
+def _tiff_layout(path, mtime=None):
+    "(tiled or pyramidal, shape, dtype) of the tiff at `path` if it holds a single 2D or YXS (RGB) series (with its pyramid levels), else None."
+    tifffile = import_package('tifffile')
+    try:
+        with tifffile.TiffFile(path) as tif:
+            if len(tif.series)!=1 or tif.series[0].axes not in ['YX', 'YXS']: return None
+            series = tif.series[0]
+            return series.pages[0].is_tiled or len(series.levels)>1, series.shape, series.dtype
+    except (OSError, ValueError): return None
+
+def _is_windowed(path):
+    "Zarr stacks and single 2D/YXS series tiffs can be read region by region, other images are read completely."
+    path = Path(path)
+    if path.suffix == '.zarr': return True
+    if path.suffix not in ['.tif', '.tiff']: return False
+    return _tiff_layout(str(path), path.stat().st_mtime) is not None
+
+def _read_by_region(path, max_bytes, native=False):
+    "Zarr stacks and tiled or pyramidal tiffs are read by region, other tiffs only if decoded (as in `_read_img`) larger than `max_bytes`."
+    path = Path(path)
+    if not _is_windowed(path): return False
+    if path.suffix == '.zarr': return True
+    windowed, shape, dtype = _tiff_layout(str(path), path.stat().st_mtime)
+    # Strips are decoded again for each region, cached images are decoded once
+    return windowed or np.prod(shape)*(np.dtype(dtype).itemsize if native else 8) > max_bytes
+
+_Z_PROJECTIONS = ['max', 'mean', 'sum', 'focus']
+
+def _focus_index(data):
+    "Index of the best focused z-slice of a (z, c, y, x) stack (highest variance of the Laplacian), read slice by slice."
+    scores = [max(ndimage.laplace(c.astype('float32')).var() for c in data[z]) for z in range(data.shape[0])]
+    return int(np.argmax(scores))
+
+def _z_project(data, ys, xs, mode='max', focus=None):
+    "Projects region (`ys`, `xs`) of a (z, c, y, x) stack along z, reading one z-chunk at a time."
+    assert mode in _Z_PROJECTIONS, f'Projection must be one of {_Z_PROJECTIONS}'
+    if mode=='focus': return data[focus, :, ys, xs]
+    out, step = None, data.chunks[0]
+    for z in range(0, data.shape[0], step):
+        chunk = data[z:z+step, :, ys, xs]
+        red = chunk.max(0) if mode=='max' else chunk.sum(0, dtype='float64')
+        if out is None: out = red
+        elif mode=='max': np.maximum(out, red, out=out)
+        else: out += red
+    return out/data.shape[0] if mode=='mean' else out
+
+def _zarr_projection(path, data, mode='max', level=0, cache_dir=None, block=1024, n_jobs=None):
+    "Projects a (z, c, y, x) stack once in parallel (y, x)-blocks and caches it as (y, x, c) memory-map in `cache_dir`."
+    # Modifications of the store, also of chunks rewritten in place, are detected by the times and sizes of its files
+    path = Path(path)
+    stats = [p.stat() for p in path.rglob('*') if p.is_file()]
+    state = (len(stats), max((s.st_mtime_ns for s in stats), default=0), sum(s.st_size for s in stats))
+    key = hashlib.md5(f'{path.resolve()}_{state}_{level}_{mode}'.encode()).hexdigest()
+    cache_path = Path(cache_dir)/f'projection_{key}.npy'
+    if not cache_path.exists():
+        cache_path.parent.mkdir(exist_ok=True, parents=True)
+        focus = _focus_index(data) if mode=='focus' else None
+        dtype = data.dtype if mode in ['max', 'focus'] else 'float64'
+        tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(*data.shape[2:], data.shape[1]))
+        # Blocks are aligned to the chunks of the stack
+        bs = [max(block//c, 1)*c for c in data.chunks[2:]]
+        blocks = [(slice(y, y+bs[0]), slice(x, x+bs[1])) for y in range(0, data.shape[2], bs[0]) for x in range(0, data.shape[3], bs[1])]
+        def _fill(b): out[b] = np.moveaxis(_z_project(data, *b, mode, focus), 0, -1)
+        with ThreadPoolExecutor(n_jobs) as ex: list(ex.map(_fill, blocks))
+        out.flush()
+        del out
+        os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
+
+class _RegionReader:
+    "Array-like image of shape (y, x, channels) that only reads (and normalizes) the requested region from tiff (pyramid) or zarr files."
+    def __init__(self, path, divide=None, level=0, projection='max', cache_dir=None, native=False):
+        self.path, self.divide, self.projection, self.native, self._focus = Path(path), divide, projection, native, None
+        zarr = import_package('zarr')
+        if self.path.suffix == '.zarr':
+            data = zarr.open(str(self.path), mode='r')
+            if isinstance(data, zarr.Group): data = data[str(level)] # OME-Zarr multiscales
+            self.shape = (*data.shape[2:], data.shape[1]) # assuming shape (z_dim, n_channel, y_dim, x_dim)
+            if cache_dir is not None: data = _zarr_projection(self.path, data, projection, level, cache_dir)
+            self.dtype = data.dtype if projection in ['max', 'focus'] else np.dtype('float64')
+            self.scale = 1. # zarr stacks are not normalized
+        else:
+            tifffile = import_package('tifffile')
+            data = zarr.open(tifffile.imread(self.path, aszarr=True, level=level), mode='r')
+            self.shape = data.shape if data.ndim==3 else (*data.shape, 1)
+            self.dtype, self.scale = data.dtype, _img_scale(data.dtype, divide)
+        self.data = data
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, sl):
+        "Reads region `sl` (slices in y and x, all channels)"
+        ys, xs = ((sl if isinstance(sl, tuple) else (sl,)) + (slice(None),)*2)[:2]
+        if self.path.suffix == '.zarr':
+            if self.data.ndim == 3: return np.asarray(self.data[ys, xs]) # cached projection
+            if self.projection == 'focus' and self._focus is None: self._focus = _focus_index(self.data)
+            return np.moveaxis(_z_project(self.data, ys, xs, self.projection, self._focus), 0, -1)
+        img = self.data[ys, xs]
+        if img.ndim == 2: img = img[..., None]
+        if self.native: return img
+        if self.divide is not None: return img/self.divide
+        if np.issubdtype(img.dtype, np.integer): return img/np.iinfo(img.dtype).max
+        return img
+
+def _open_img(path, divide=None, level=0, projection='max', cache_dir=None, native=False):
+    "Opens 2D tiff and zarr images for reading regions, other images are read completely."
+    if _is_windowed(path): return _RegionReader(path, divide, level, projection, cache_dir, native)
+    return _read_img(path, divide=divide, native=native)
+
+def _value_scale(img, divide=None):
+    "Factor that maps the values of `img` (array or `_RegionReader`) to the 0-1 range"
+    return img.scale if isinstance(img, _RegionReader) else _img_scale(img.dtype, divide)
+
+# Data types of PIL image modes as read by imageio
+_PIL_DTYPES = {'L':'uint8', 'LA':'uint8', 'P':'uint8', 'RGB':'uint8', 'RGBA':'uint8', 'I;16':'uint16', 'I;16B':'uint16', 'I;16L':'uint16'}
+
+def _image_scale(path, divide=None):
+    "`_value_scale` of the image at `path`, read from the image header if possible."
+    if _is_windowed(path): return _RegionReader(path, divide).scale
+    try:
+        with Image.open(path) as im: return _img_scale(np.dtype(_PIL_DTYPES[im.mode]), divide)
+    except (OSError, KeyError): return _value_scale(_read_img(path, native=True), divide)
+
+# Cell
+def _remove_cache_dir(path, pid):
+    "Removes the cache directory `path` when the process `pid` that created it exits"
+    if os.getpid()==pid: shutil.rmtree(path, ignore_errors=True)
+
+class ImageCache:
+    "LRU cache of decoded images, shared by all processes as memory-mapped files in `path` (shared memory by default) within `max_bytes`"
+    def __init__(self, max_bytes=2*1024**3, path=None):
+        self.max_bytes = max_bytes
+        if path is None:
+            shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            self.path = Path(tempfile.mkdtemp(prefix='deepflash2_images_', dir=shm))
+            weakref.finalize(self, _remove_cache_dir, self.path, os.getpid())
+        else:
+            self.path = Path(path)
+            self.path.mkdir(exist_ok=True, parents=True)
+
+    def _cache_fn(self, file, read_fn, **kwargs):
+        "Cache file of `file`, addressed by its path, modification time, and the reading arguments"
+        stat = Path(file).stat()
+        key = f'{Path(file).resolve()}_{stat.st_mtime}_{stat.st_size}_{read_fn.__name__}_{sorted(kwargs.items())}'
+        return self.path/f'{hashlib.md5(key.encode()).hexdigest()}.npy'
+
+    def __call__(self, file, read_fn, **kwargs):
+        "Returns the decoded image `read_fn(file, **kwargs)`, only decoded if not in the cache"
+        cache_path = self._cache_fn(file, read_fn, **kwargs)
+        try:
+            img = np.load(cache_path, mmap_mode='r')
+            os.utime(cache_path) # mark as recently used
+            return img
+        except (OSError, ValueError): pass
+        img = np.asarray(read_fn(file, **kwargs))
+        max_bytes = self._budget()
+        if img.nbytes <= max_bytes:
+            self.evict(max_bytes - img.nbytes)
+            tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+            try:
+                with open(tmp_path, 'wb') as f: np.save(f, img)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                # E.g., a full file system, the image is used without caching
+                try: tmp_path.unlink()
+                except OSError: pass
+        return img
+
+    def _budget(self):
+        "`max_bytes`, limited to the size of the cache and the free space of its file system (e.g., a small /dev/shm in docker)"
+        try: return min(self.max_bytes, self.nbytes + shutil.disk_usage(self.path).free)
+        except OSError: return 0
+
+    def evict(self, max_bytes=0):
+        "Removes least recently used images until the cache fits into `max_bytes`"
+        entries = []
+        for p in self.path.glob('*.npy'):
+            try: entries.append((p.stat().st_mtime, p.stat().st_size, p))
+            except FileNotFoundError: pass
+        total = sum(e[1] for e in entries)
+        for _, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= max_bytes: break
+            # Processes that already mapped the image keep reading it
+            try: p.unlink()
+            except FileNotFoundError: pass
+            total -= size
+
+    @property
+    def nbytes(self):
+        return sum(p.stat().st_size for p in self.path.glob('*.npy'))
+
 # Cell
 def _read_msk(path, n_classes=2, instance_labels=False, **kwargs):
     "Read image and check classes"
@@ -321,63 +735,236 @@ def _read_msk(path, n_classes=2, instance_labels=False, **kwargs):
         assert len(np.unique(msk))<=n_classes, 'Check n_classes and provided mask'
     return msk
 
+# Cell
+def _save_cached_data(path, lbl, wgt, pdf):
+    "Saves preprocessed label (mask), weight, pdf, and cumulative pdf data as uncompressed arrays that can be memory-mapped."
+    path.mkdir(exist_ok=True, parents=True)
+    np.save(path/'lbl.npy', lbl.astype(np.min_scalar_type(lbl.max())))
+    np.save(path/'wgt.npy', wgt)
+    np.save(path/'pdf.npy', pdf)
+    np.save(path/'cdf.npy', np.cumsum(pdf, dtype='float64'))
+
 # Cell
 def _get_cached_data(path):
-    "Loads preprocessed and compressed label (mask), weight, and pdf data."
-    with open(path, 'rb') as f:
-        tmp = np.load(f)
-        return tmp['lbl'], tmp['wgt'], tmp['pdf']
+    "Loads preprocessed label (mask), weight, and pdf data as memory-maps."
+    return tuple(np.load(path/f'{k}.npy', mmap_mode='r') for k in ['lbl', 'wgt', 'pdf'])
+
+def _get_cached_cdf(path):
+    "Loads the cumulative pdf as memory-map (created on first use for caches without it)."
+    cdf_path = path/'cdf.npy'
+    if not cdf_path.is_file():
+        tmp_path = path/f'cdf.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, np.cumsum(_get_cached_data(path)[2], dtype='float64'))
+        os.replace(tmp_path, cdf_path)
+    return np.load(cdf_path, mmap_mode='r')
+
+def _sample_center(cdf, shape, rng=np.random):
+    "Draws a random position in `shape` with probability proportional to the pdf, O(log n) with binary search on `cdf`."
+    return np.unravel_index(min(np.searchsorted(cdf, rng.random()*cdf[-1], side='right'), cdf.size-1), shape)
+
+# Cell
+def _crop_reflect(data, start, shape):
+    "Crops `shape` at `start` from the first dimensions of `data` (also array-likes as `_RegionReader`), outside regions are mirrored as in `map_coordinates(mode='reflect')`."
+    idx = []
+    for s, n, d in zip(start, shape, data.shape):
+        i = np.arange(s, s+n) % (2*d)
+        idx.append(np.where(i>=d, 2*d-1-i, i))
+    # Only the window containing all (mirrored) positions is read
+    window = np.asarray(data[tuple(slice(i.min(), i.max()+1) for i in idx)])
+    if all(np.array_equal(i, np.arange(i[0], i[0]+len(i))) for i in idx): return window
+    return window[np.ix_(*[i-i.min() for i in idx])]
+
+# Cell
+def _tile_views(data, centers, shape):
+    "Axis-aligned tiles of `shape` around `centers` as views of `data` padded once as in `map_coordinates(mode='reflect')`."
+    starts = np.array(centers) - np.array(shape)//2
+    lo = np.maximum(-starts.min(0), 0)
+    hi = np.maximum((starts + shape).max(0) - data.shape[:len(shape)], 0)
+    padded = np.pad(data, [*zip(lo, hi)] + [(0, 0)]*(data.ndim-len(shape)), mode='symmetric')
+    return [padded[tuple(slice(s+l, s+l+n) for s, l, n in zip(start, lo, shape))] for start in starts]
+
+# Cell
+class _ValueCurve:
+    "Quadratic intensity curve through (0, `y0`), (0.5, `y1`), and (1, `y2`), evaluated in closed form"
+    def __init__(self, y0=0., y1=.5, y2=1., scale=1.):
+        # For values in units of 1/`scale` (e.g. native image dtypes), the curve is rescaled to keep these units
+        a = 2*(y2 - 2*y1 + y0)
+        self.coef = np.array([a*scale, y2 - y0 - a, y0/scale])
+
+    def __call__(self, x):
+        a, b, c = self.coef.astype(x.dtype if x.dtype.kind=='f' else 'float32')
+        if a==0 and b==1 and c==0: return x
+        # Horner scheme, only one new array
+        y = x*a
+        y += b
+        y *= x
+        y += c
+        return y
+
+# Cell
+# Approximate peak memory of `calculate_weights` in bytes per mask pixel (distance maps per class and weights)
+def _weight_mem(n_pixels, n_classes=2): return n_pixels*(24*n_classes+32)
+
+def _available_mem():
+    "Available memory in GB (from `psutil` if installed), `None` if unknown."
+    try:
+        import psutil
+        return psutil.virtual_memory().available/1e9
+    except ImportError:
+        try: return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')/1e9
+        except (AttributeError, ValueError, OSError): return None
+
+def _mask_pixels(path):
+    "Number of pixels of a mask, read from the image header if possible."
+    try:
+        with Image.open(path) as im: return im.size[0]*im.size[1]*getattr(im, 'n_frames', 1)
+    except:
+        return _read_msk(path, instance_labels=True).size
+
+def _image_shape(path, level=0):
+    "Spatial shape of an image, read from the image header if possible."
+    if _is_windowed(path): return _RegionReader(path, level=level).shape[:2]
+    try:
+        with Image.open(path) as im: return im.size[::-1]
+    except:
+        return _read_img(path).shape[:-1]
+
+def _preproc_mask(label_path, cache_path, instance_labels=False, n_classes=2, ignore=None, **kwargs):
+    "Calculates weights of the mask at `label_path` and writes them to `cache_path`, returns the manifest entry."
+    if instance_labels:
+        clabels = None
+        instlabels = _read_msk(label_path, instance_labels=True)
+    else:
+        clabels = _read_msk(label_path, n_classes)
+        instlabels = None
+    lbl, wgt, pdf = calculate_weights(clabels, instlabels, ignore=ignore, n_dims=n_classes, **kwargs)
+    _save_cached_data(cache_path, lbl, wgt, pdf)
+    counts = np.bincount(lbl.ravel())
+    return {'shape':lbl.shape, 'dtypes':{'lbl':str(np.min_scalar_type(lbl.max())), 'wgt':str(wgt.dtype), 'pdf':str(pdf.dtype)},
+            'class_counts':{str(c):int(n) for c, n in enumerate(counts) if n>0}}
 
 # Cell
 class BaseDataset(Dataset):
+    _process_state = () # attributes of the current process, not pickled for workers or copied to subsets
     def __init__(self, files, label_fn=None, create_weights=True, instance_labels = False, n_classes=2, divide=None, ignore={},
-                 tile_shape=(540,540), padding=(184,184),preproc_dir=None, bws=6, fds=1, bwf=50, fbr=.1, n_jobs=1, verbose=10, **kwargs):
+                 tile_shape=(540,540), padding=(184,184),preproc_dir=None, bws=6, fds=1, bwf=50, fbr=.1, weight_engine='local', weight_mode='exact',
+                 distance_cache=False, n_jobs=1, max_mem=None, pyramid_level=0, zarr_projection='max', native_dtype=False, image_cache=None,
+                 verbose=10, **kwargs):
         store_attr('files, label_fn, instance_labels, create_weights, divide, n_classes, ignore, tile_shape, \
-                    padding, bws, fds, bwf, fbr')
+                    padding, bws, fds, bwf, fbr, weight_engine, weight_mode, distance_cache, pyramid_level, zarr_projection, \
+                    native_dtype, image_cache')
         self.c = n_classes
+        # Images in their native dtype need the same value range, otherwise they are read as floats in the 0-1 range
+        if native_dtype and len({_image_scale(f, divide) for f in self.files})>1: self.native_dtype = False
         if self.label_fn is None: self.create_weights=False
         if label_fn is not None:
             if not preproc_dir: self.preproc_dir = Path(label_fn(files[0])).parent/'.cache'
             else: self.preproc_dir = Path(preproc_dir)
             self.preproc_dir.mkdir(exist_ok=True, parents=True)
-            if create_weights: self._create_weights(n_jobs, verbose)
-
-    def _cache_fn(self, o):
-        "Creates path to preprocessed and compressed data."
-        return self.preproc_dir/f'{o}_{self.bws}_{self.fds}_{self.bwf}_{self.fbr}.npz'
+            self._load_manifest()
+            if create_weights: self._create_weights(n_jobs, max_mem, verbose)
+            # Project zarr stacks once before they are read tile by tile
+            for f in self.files:
+                if f.suffix == '.zarr': self._open(f)
+        # Images in their native dtype are mapped to the 0-1 range by `scale` (see `ScaleNormalize`)
+        self.scale = _image_scale(self.files[0], divide) if self.native_dtype else 1.
+
+    def _load_manifest(self):
+        "Loads index of mask hashes and cached data from `preproc_dir`."
+        self.mask_keys = {}
+        try:
+            with open(self.preproc_dir/'manifest.json') as f: self.manifest = json.load(f)
+        except:
+            self.manifest = {'masks':{}, 'cache':{}}
+
+    def _save_manifest(self):
+        "Merges index with the saved manifest and writes it atomically."
+        manifest_path = self.preproc_dir/'manifest.json'
+        try:
+            with open(manifest_path) as f: saved = json.load(f)
+            for k in self.manifest: saved[k].update(self.manifest[k])
+            self.manifest = saved
+        except: pass
+        tmp_path = manifest_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f: json.dump(self.manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+    def _mask_key(self, file):
+        "Content hash of the mask (and ignored regions) of `file`, only modified masks are rehashed."
+        if file.name in self.mask_keys: return self.mask_keys[file.name]
+        label_path = self.label_fn(file)
+        stat = label_path.stat()
+        entry = self.manifest['masks'].get(str(label_path))
+        if entry is None or entry['mtime']!=stat.st_mtime or entry['size']!=stat.st_size:
+            entry = {'mtime':stat.st_mtime, 'size':stat.st_size, 'hash':hashlib.md5(label_path.read_bytes()).hexdigest()}
+            self.manifest['masks'][str(label_path)] = entry
+        key = entry['hash']
+        if file.name in self.ignore: key = hashlib.md5(f'{key}{_mask_hash(self.ignore[file.name])}'.encode()).hexdigest()
+        self.mask_keys[file.name] = key
+        return key
+
+    def _cache_fn(self, f):
+        "Creates path to preprocessed data, addressed by mask content and parameters."
+        mode = '' if self.weight_mode=='exact' else f'_{self.weight_mode}'
+        return self.preproc_dir/f'{self._mask_key(f)}_{self.bws}_{self.fds}_{self.bwf}_{self.fbr}{mode}'
+
+    def _is_cached(self, f):
+        "Checks if preprocessed data of `f` is listed in the manifest."
+        cache_path = self._cache_fn(f)
+        return cache_path.name in self.manifest['cache'] and cache_path.is_dir()
+
+    def _open(self, file):
+        "Opens `file` for region reads (zarr stacks are projected along z and cached in `preproc_dir`) or from the `image_cache`."
+        if self.image_cache is not None and not self._by_region(file):
+            img = self.image_cache(file, _read_img, divide=self.divide, native=self.native_dtype)
+        else:
+            img = _open_img(file, self.divide, self.pyramid_level, self.zarr_projection, getattr(self, 'preproc_dir', None), self.native_dtype)
+        if self.native_dtype and hasattr(self, 'scale'):
+            assert _value_scale(img, self.divide)==self.scale, f'Images in their native dtype need the same value range, check {file.name}'
+        return img
+
+    def _by_region(self, file):
+        "Checks if `file` is read by region, images that fit into the `image_cache` are decoded once instead."
+        if self.image_cache is None: return _is_windowed(file)
+        return _read_by_region(file, self.image_cache.max_bytes, self.native_dtype)
+
+    def _preproc_kwargs(self, file):
+        "Arguments of `_preproc_mask` for `file`."
+        return {'label_path':self.label_fn(file), 'cache_path':self._cache_fn(file), 'instance_labels':self.instance_labels,
+                'n_classes':self.c, 'ignore':self.ignore.get(file.name), 'bws':self.bws, 'fds':self.fds, 'bwf':self.bwf,
+                'fbr':self.fbr, 'engine':self.weight_engine, 'mode':self.weight_mode,
+                'cache_dir':self.preproc_dir if self.distance_cache else None}
 
     def _preproc(self, file):
         "Preprocesses and saves labels (msk), weights, and pdf."
-        label_path = self.label_fn(file)
-        if self.instance_labels:
-            clabels = None
-            instlabels = _read_msk(label_path, instance_labels=True)
-        else:
-            clabels = _read_msk(label_path, self.c)
-            instlabels = None
-        ign = self.ignore[file.name] if file.name in self.ignore else None
-        lbl, wgt, pdf = calculate_weights(clabels, instlabels, ignore=ign, n_dims=self.c,
-                                          bws=self.bws, fds=self.fds, bwf=self.bwf, fbr=self.fbr)
-        np.savez_compressed(self._cache_fn(file.name), lbl=lbl, wgt=wgt, pdf=pdf)
-
-    def _create_weights(self, n_jobs=1, verbose=0):
-        using_cache = False
-        preproc_queue=L()
+        return self._cache_fn(file).name, {'file':file.name, **_preproc_mask(**self._preproc_kwargs(file))}
+
+    def _create_weights(self, n_jobs=1, max_mem=None, verbose=0):
+        "Creates missing weights in worker processes, largest masks first and within `max_mem` (GB, defaults to the available memory)."
+        missing = {}
         for f in self.files:
-            try:
-                lbl, wgt, pdf = _get_cached_data(self._cache_fn(f.name))
-                if not using_cache:
-                    if verbose>0: print(f'Using cached mask weights from {self.preproc_dir}')
-                    using_cache = True
-            except:
-                if n_jobs==1:
+            if not self._is_cached(f): missing.setdefault(self._cache_fn(f), f)
+        if len(missing)<len(self.files):
+            if verbose>0: print(f'Using cached mask weights from {self.preproc_dir}')
+        if len(missing)>0:
+            n_pixels = {f:_mask_pixels(self.label_fn(f)) for f in missing.values()}
+            preproc_queue = L(sorted(missing.values(), key=lambda f: n_pixels[f], reverse=True))
+            n_jobs = min(effective_n_jobs(n_jobs), len(preproc_queue))
+            if max_mem is None: max_mem = _available_mem()
+            if max_mem is not None:
+                n_jobs = max(1, min(n_jobs, int(max_mem*1e9//_weight_mem(n_pixels[preproc_queue[0]], self.c))))
+            if n_jobs==1:
+                entries = []
+                for f in preproc_queue:
                     if verbose>0: print('Creating weights for', f.name)
-                    self._preproc(f)
-                else:
-                    preproc_queue.append(f)
-        if len(preproc_queue)>0:
-            if verbose>0: print('Creating weights for', L([f.name for f in preproc_queue]))
-            _ = Parallel(n_jobs=n_jobs, verbose=verbose, backend='threading')(delayed(self._preproc)(f) for f in preproc_queue)
+                    entries.append(self._preproc(f))
+            else:
+                if verbose>0: print('Creating weights for', L([f.name for f in preproc_queue]))
+                res = Parallel(n_jobs=n_jobs, verbose=verbose, backend='loky')(
+                    delayed(_preproc_mask)(**self._preproc_kwargs(f)) for f in preproc_queue)
+                entries = [(self._cache_fn(f).name, {'file':f.name, **e}) for f, e in zip(preproc_queue, res)]
+            self.manifest['cache'].update(entries)
+        self._save_manifest()
 
     def get_data(self, files=None, max_n=None, mask=False):
         if files is not None:
@@ -389,8 +976,8 @@ class BaseDataset(Dataset):
             files = self.files
         data_list = L()
         for f in files:
-            if mask: d, _, _ = _get_cached_data(self._cache_fn(f.name))
-            else: d = _read_img(f, divide=self.divide)
+            if mask: d, _, _ = _get_cached_data(self._cache_fn(f))
+            else: d = _read_img(f, divide=self.divide, projection=self.zarr_projection)
             data_list.append(d)
         return data_list
 
@@ -403,9 +990,9 @@ class BaseDataset(Dataset):
             files = self.files[:max_n]
         if figsize is None: figsize = (ncols*12, max_n//ncols * 5)
         for f in files:
-            img = _read_img(f, divide=self.divide)
+            img = _read_img(f, divide=self.divide, projection=self.zarr_projection)
             if self.create_weights and (self.label_fn is not None):
-                lbl, wgt, _ = _get_cached_data(self._cache_fn(f.name))
+                lbl, wgt, _ = _get_cached_data(self._cache_fn(f))
                 show(img, lbl, wgt, file_name=f.name, figsize=figsize, show_bbox=False, **kwargs)
             elif self.label_fn is not None:
                 lbl = _read_msk(self.label_fn(f), instance_labels=self.instance_labels)
@@ -413,6 +1000,16 @@ class BaseDataset(Dataset):
             else:
                 show(img, file_name=f.name, figsize=figsize, show_bbox=False, **kwargs)
 
+    def __getstate__(self):
+        return {k:v for k,v in self.__dict__.items() if k not in self._process_state}
+
+    def subset(self, files):
+        "View of the dataset for `files` that shares its preprocessed data."
+        # `copy` goes through `__getstate__`, per-process state keyed by our file indices is not shared
+        ds = copy(self)
+        ds.files = L(files)
+        return ds
+
     def clear_cached_weights(self):
         "Clears cache directory with pretrained weights."
         print(f"Deleting all cache at {self.preproc_dir}")
@@ -424,7 +1021,7 @@ class BaseDataset(Dataset):
         print('Computing Stats...')
         mean_sum, var_sum = 0., 0.
         for i, f in enumerate(self.files, 1):
-            img = _read_img(f, divide=self.divide)
+            img = _read_img(f, divide=self.divide, projection=self.zarr_projection)
             mean_sum += img.mean((0,1))
             var_sum += img.var((0,1))
             if i==max_samples:
@@ -440,20 +1037,36 @@ class RandomTileDataset(BaseDataset):
     Pytorch Dataset that creates random tiles with augmentations from the input images.
     """
     n_inp = 1
+    _process_state = ('_loaded',)
     def __init__(self, *args, sample_mult=None, flip=True, rotation_range_deg=(0, 360), deformation_grid=(150, 150), deformation_magnitude=(10, 10),
-                 value_minimum_range=(0, 0), value_maximum_range=(1, 1), value_slope_range=(1, 1), **kwargs):
+                 value_minimum_range=(0, 0), value_maximum_range=(1, 1), value_slope_range=(1, 1), deformation_bank_size=None,
+                 batch_augmentation=False, tiles_per_image=1, seed=None, **kwargs):
         super().__init__(*args, **kwargs)
         store_attr('sample_mult, flip, rotation_range_deg, deformation_grid, deformation_magnitude, value_minimum_range, \
-                    value_maximum_range, value_slope_range')
+                    value_maximum_range, value_slope_range, deformation_bank_size, \
+                    batch_augmentation, tiles_per_image')
 
         # Sample mulutiplier: Number of random samplings from augmented image
         if self.sample_mult is None:
             tile_shape = np.array(self.tile_shape)-np.array(self.padding)
-            msk_shape = np.array(self.get_data(max_n=1)[0].shape[:-1])
+            msk_shape = np.array(_image_shape(self.files[0], self.pyramid_level))
             #msk_shape = np.array(lbl.shape[-2:])
             self.sample_mult = int(np.product(np.floor(msk_shape/tile_shape)))
 
-        self.on_epoch_end()
+        # Augmentations of an epoch are derived from `seed` and the epoch counter, which is shared with dataloader workers
+        self.seed = seed if seed is not None else np.random.randint(2**31)
+        self._epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self._set_epoch(0)
+
+        # Bank of deformation fields for individual augmentations per sample
+        self.deformation_bank = None
+        if self.deformation_bank_size:
+            self.deformation_bank = DeformationFieldBank(self._random_deformation_field, self.deformation_bank_size, seed=self.seed)
+
+        # Crops that contain all deformed tile coordinates (for windowed reading and `BatchDeformation`)
+        if self.batch_augmentation: assert len(self.tile_shape)==2, 'Batch augmentation is only implemented for 2D tiles'
+        margin = 4*max(self.deformation_magnitude) if self.deformation_grid is not None else 0
+        self.crop_half = int(np.ceil(np.sqrt(np.sum((np.array(self.tile_shape)/2)**2)) + margin)) + 1
 
     def __len__(self):
         return len(self.files)*self.sample_mult
@@ -462,21 +1075,26 @@ class RandomTileDataset(BaseDataset):
         idx = idx % len(self.files)
         if torch.is_tensor(idx):
             idx = idx.tolist()
+        if self._pid != os.getpid() or self.epoch != int(self._epoch): self._set_epoch(int(self._epoch))
 
-        img_path = self.files[idx]
-        img = _read_img(img_path, divide=self.divide)
-        n_channels = img.shape[-1]
+        img, labels, weights, cdf = self._load(idx)
 
-        labels, weights, pdf = _get_cached_data(self._cache_fn(img_path.name))
-
-        cumulatedPdf = np.cumsum(pdf/np.sum(pdf))
         # Random center
-        center = np.unravel_index(np.argmax(cumulatedPdf > np.random.random()), pdf.shape)
-        X = self.gammaFcn(self.deformationField.apply(img, center).flatten()).reshape((*self.tile_shape, n_channels))
+        center = _sample_center(cdf, labels.shape, self.rng)
+        deformationField = self.deformation_bank.draw(self.rng) if self.deformation_bank is not None else self.deformationField
+        if self.batch_augmentation: return self._raw_tile(img, labels, weights, center, deformationField)
+        img_center = center
+        if isinstance(img, _RegionReader) or self.native_dtype:
+            # Only the region around the tile is read (and converted for interpolation)
+            start = [c-self.crop_half for c in center]
+            img = _crop_reflect(img, start, (2*self.crop_half,)*2)
+            img_center = [c-s for c, s in zip(center, start)]
+            if self.native_dtype: img = img.astype('float32')
+        X = self.gammaFcn(deformationField.apply(img, img_center).astype('float32'))
         X = np.moveaxis(X, -1, 0)
-        Y = self.deformationField.apply(labels, center, self.padding, 0)
+        Y = deformationField.apply(labels, center, self.padding, 0)
         # To categorical
-        W = self.deformationField.apply(weights, center, self.padding, 1)
+        W = deformationField.apply(weights, center, self.padding, 1)
 
         X = X.astype('float32')
         Y = Y.astype('int64')
@@ -484,49 +1102,146 @@ class RandomTileDataset(BaseDataset):
 
         return  TensorImage(X), TensorMask(Y), W
 
-    def on_epoch_end(self, verbose=False):
-
-        if verbose: print("Generating deformation field")
-        self.deformationField = DeformationField(self.tile_shape)
+    def _load(self, idx):
+        "Image `idx` with its labels, weights, and cdf, the last image is kept for grouped sampling (see `shuffle_fn`)."
+        loaded = getattr(self, '_loaded', None)
+        if loaded is not None and loaded[0]==idx: return loaded[1]
+        img_path = self.files[idx]
+        labels, weights, _ = _get_cached_data(self._cache_fn(img_path))
+        data = (self._open(img_path), labels, weights, _get_cached_cdf(self._cache_fn(img_path)))
+        if self.tiles_per_image>1: self._loaded = (idx, data)
+        return data
+
+    def shuffle_fn(self, idxs):
+        "Shuffles `idxs` in groups of `tiles_per_image` samples from the same image, pass it as `partial(RandomTileDataset.shuffle_fn, ds)` to fastai dataloaders."
+        idxs, n, k = self.rng.permutation(np.array(idxs)), len(self.files), self.tiles_per_image
+        groups = []
+        for i in range(n):
+            img_idxs = idxs[idxs % n == i]
+            groups += [img_idxs[j:j+k] for j in range(0, len(img_idxs), k)]
+        return np.concatenate([groups[g] for g in self.rng.permutation(len(groups))]).tolist()
+
+    def subset(self, files, seed=None):
+        "View of the dataset for `files` that shares its preprocessed data, with own augmentations from `seed`."
+        ds = super().subset(files)
+        ds.seed = seed if seed is not None else np.random.randint(2**31)
+        ds._epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        ds._set_epoch(0)
+        if self.deformation_bank_size:
+            ds.deformation_bank = DeformationFieldBank(ds._random_deformation_field, self.deformation_bank_size, seed=ds.seed)
+        return ds
+
+    def _raw_tile(self, img, labels, weights, center, deformationField):
+        "Crops around `center` and the normalized sampling grid of `deformationField` for `BatchDeformation`"
+        start = [c-self.crop_half for c in center]
+        crop_shape = (2*self.crop_half,)*2
+        X = np.moveaxis(_crop_reflect(img, start, crop_shape), -1, 0)
+        if not self.native_dtype: X = X.astype('float32')
+        Y = _crop_reflect(labels, start, crop_shape).astype('int64')
+        W = _crop_reflect(weights, start, crop_shape).astype('float32')
+        coords = [(d-s).reshape(self.tile_shape) for d, s in zip(deformationField.get(center), start)]
+        grid = np.stack(coords[::-1], axis=-1)/(crop_shape[0]-1)*2-1
+        return TensorImage(X), TensorMask(Y), W, grid.astype('float32'), self.gammaFcn.coef.astype('float32')
+
+    def _random_deformation_field(self, rng):
+        "Creates a deformation field with random rotation, mirroring, and elastic deformation"
+        deformationField = DeformationField(self.tile_shape)
 
         if self.rotation_range_deg[1] > self.rotation_range_deg[0]:
-            self.deformationField.rotate(
-                theta=np.pi * (np.random.random()
+            deformationField.rotate(
+                theta=np.pi * (rng.random()
                             * (self.rotation_range_deg[1] - self.rotation_range_deg[0])
                             + self.rotation_range_deg[0])
                             / 180.0)
 
         if self.flip:
-            self.deformationField.mirror(np.random.choice((True,False),2))
+            deformationField.mirror(rng.choice((True,False),2))
 
         if self.deformation_grid is not None:
-            self.deformationField.addRandomDeformation(
-                self.deformation_grid, self.deformation_magnitude)
+            deformationField.addRandomDeformation(
+                self.deformation_grid, self.deformation_magnitude, rng=rng)
+        return deformationField
+
+    def on_epoch_end(self, verbose=False):
+        "Starts the next epoch with new augmentations, also in (persistent) dataloader workers"
+        self._epoch += 1
+        self._set_epoch(int(self._epoch), verbose)
+
+    def _set_epoch(self, epoch, verbose=False):
+        "Derives the augmentations of `epoch` (the same in all processes) and the sample generator of this process."
+        worker_info = torch.utils.data.get_worker_info()
+        self.epoch, self._pid = epoch, os.getpid()
+        self.rng = np.random.RandomState([self.seed, epoch, worker_info.id+1 if worker_info is not None else 0])
+        rng = np.random.RandomState([self.seed, epoch])
+        if getattr(self, 'deformation_bank', None) is not None: self.deformation_bank.set_epoch(epoch)
+
+        if not self.deformation_bank_size:
+            if verbose: print("Generating deformation field")
+            self.deformationField = self._random_deformation_field(rng)
 
         if verbose: print("Generating value augmentation function")
         minValue = (self.value_minimum_range[0]
             + (self.value_minimum_range[1] - self.value_minimum_range[0])
-            * np.random.random())
+            * rng.random())
 
         maxValue = (self.value_maximum_range[0]
             + (self.value_maximum_range[1] - self.value_maximum_range[0])
-            * np.random.random())
+            * rng.random())
 
         intermediateValue = 0.5 * (
             self.value_slope_range[0]
             + (self.value_slope_range[1] - self.value_slope_range[0])
-            * np.random.random())
+            * rng.random())
+
+        self.gammaFcn = _ValueCurve(minValue, intermediateValue, maxValue, self.scale)
 
-        self.gammaFcn = interp1d([0, 0.5, 1.0], [minValue, intermediateValue, maxValue], kind="quadratic")
+# Cell
+class BatchDeformation(ItemTransform):
+    "Warps and value-augments batches of raw crops from `RandomTileDataset(batch_augmentation=True)` with `grid_sample`"
+    order = 0
+    def __init__(self, padding=(184,184)):
+        store_attr()
+
+    def encodes(self, b):
+        if len(b)!=5: return b
+        x, y, w, grid, gamma = b
+        sl = tuple(slice(int(p / 2), int(-p / 2)) if p > 0 else slice(None) for p in self.padding)
+        grid_y = grid[(slice(None), *sl)]
+        x = F.grid_sample(x.float(), grid, mode='bilinear', padding_mode='reflection', align_corners=True)
+        x = gamma[:, 0, None, None, None]*x**2 + gamma[:, 1, None, None, None]*x + gamma[:, 2, None, None, None]
+        y = F.grid_sample(y[:, None].float(), grid_y, mode='nearest', padding_mode='reflection', align_corners=True)[:, 0]
+        w = F.grid_sample(w[:, None], grid_y, mode='bilinear', padding_mode='reflection', align_corners=True)[:, 0]
+        return TensorImage(x), TensorMask(y.long()), w
+
+# Cell
+class ScaleNormalize(Normalize):
+    "Normalizes batches of images in their native dtype, mapped to the 0-1 range by `scale`, in one float32 operation"
+    def __init__(self, mean=None, std=None, scale=1., axes=(0,2,3)):
+        super().__init__(mean, std, axes)
+        self.scale = scale
+
+    @classmethod
+    def from_stats(cls, mean, std, scale=1., dim=1, ndim=4, cuda=True): return cls(*broadcast_vec(dim, ndim, mean, std, cuda=cuda), scale=scale)
+
+    def encodes(self, x:TensorImage):
+        # (x*scale - mean)/std as one multiply-add
+        return torch.addcmul(-self.mean/self.std, x.float(), self.scale/self.std)
+
+class ToUnitRange(DisplayedTransform):
+    "Maps batches of images in their native dtype to float32 in the 0-1 range, e.g. before `Brightness`"
+    order = 1
+    def __init__(self, scale=1.): store_attr()
+    def encodes(self, x:TensorImage): return x.float()*self.scale
 
 # Cell
 class TileDataset(BaseDataset):
     "Pytorch Dataset that creates random tiles for validation and prediction on new data."
     n_inp = 1
-    def __init__(self, *args, **kwargs):
+    _process_state = ('_pid', '_pool', '_loading', '_reader')
+    def __init__(self, *args, lazy=False, **kwargs):
         super().__init__(*args, **kwargs)
+        self.lazy = lazy
         self.output_shape = tuple(int(t - p) for (t, p) in zip(self.tile_shape, self.padding))
-        tiler = DeformationField(self.tile_shape)
         self.tile_data = []
         self.tile_labels = [] if self.label_fn is not None else None
         self.tile_weights = [] if self.label_fn is not None else None
@@ -534,28 +1249,21 @@ class TileDataset(BaseDataset):
         self.image_shapes = []
         self.in_slices = []
         self.out_slices = []
+        self.centers = []
+        self.file_tiles = []
+        self._pid = None
 
         for i, file in enumerate(progress_bar(self.files, leave=False)):
-            img = _read_img(file, divide=self.divide)
-            if self.label_fn is not None:
-                lbl, wgt, _ = _get_cached_data(self._cache_fn(file.name))
-
             # Tiling
-            data_shape = img.shape[:-1]
+            data_shape = _image_shape(file, self.pyramid_level)
+            start = len(self.centers)
             for ty in range(int(np.ceil(data_shape[0] / self.output_shape[0]))):
                 for tx in range(int(np.ceil(data_shape[1] / self.output_shape[1]))):
                     centerPos = (
                         int((ty + 0.5) * self.output_shape[0]),
                         int((tx + 0.5) * self.output_shape[1]),
                     )
-                    self.tile_data.append(tiler.apply(img, centerPos))
-                    if self.label_fn is not None:
-                        self.tile_labels.append(
-                            tiler.apply(lbl, centerPos, self.padding, order=0)
-                        )
-                        self.tile_weights.append(
-                            tiler.apply(wgt, centerPos, self.padding, order=1)
-                        )
+                    self.centers.append(centerPos)
                     self.image_indices.append(i)
                     self.image_shapes.append(data_shape)
                     sliceDef = tuple(
@@ -568,18 +1276,92 @@ class TileDataset(BaseDataset):
                         for (tIdx, o, s) in zip((ty, tx), self.output_shape, data_shape)
                     )
                     self.in_slices.append(sliceDef)
+            self.file_tiles.append((start, len(self.centers)))
+
+            if not self.lazy:
+                data, labels, weights = self._cut_tiles(i)
+                self.tile_data += data
+                if self.label_fn is not None:
+                    self.tile_labels += labels
+                    self.tile_weights += weights
+
+    def _cut_tiles(self, i):
+        "Reads image `i` (and its labels and weights) and cuts all of its tiles."
+        file = self.files[i]
+        centers = self.centers[slice(*self.file_tiles[i])]
+        img = self._open(file)
+        if isinstance(img, _RegionReader): img = img[:, :]
+        lbl, wgt = _get_cached_data(self._cache_fn(file))[:2] if self.label_fn is not None else (None, None)
+        if self._slicing():
+            data = _tile_views(img, centers, self.tile_shape)
+            if lbl is None: return data, None, None
+            return data, _tile_views(lbl, centers, self.output_shape), _tile_views(wgt, centers, self.output_shape)
+        tiler = DeformationField(self.tile_shape)
+        data = [tiler.apply(img, c) for c in centers]
+        if lbl is None: return data, None, None
+        return (data, [tiler.apply(lbl, c, self.padding, order=0) for c in centers],
+                [tiler.apply(wgt, c, self.padding, order=1) for c in centers])
+
+    def _slicing(self):
+        "Even, square tiles are cut by slicing (identical to interpolation at integer coordinates)"
+        return len(set(self.tile_shape))==1 and all(t%2==0 for t in (*self.tile_shape, *self.padding))
+
+    def _read_tile(self, idx):
+        "Reads only the region of tile `idx` from a tiff or zarr image (and its labels and weights)."
+        i, c = self.image_indices[idx], self.centers[idx]
+        if getattr(self, '_reader', (None,))[0] != i: self._reader = (i, self._open(self.files[i]))
+        data = _crop_reflect(self._reader[1], [p-t//2 for p, t in zip(c, self.tile_shape)], self.tile_shape)
+        if self.label_fn is None: return [data], None, None
+        lbl, wgt = _get_cached_data(self._cache_fn(self.files[i]))[:2]
+        start = [p-o//2 for p, o in zip(c, self.output_shape)]
+        return [data], [_crop_reflect(lbl, start, self.output_shape)], [_crop_reflect(wgt, start, self.output_shape)]
+
+    def _lazy_tiles(self, i):
+        "Tiles of image `i` while the next image is loaded in the background (per process, e.g. dataloader worker)."
+        if self._pid != os.getpid():
+            self._pid, self._pool, self._loading = os.getpid(), ThreadPoolExecutor(1), {}
+        for j in (i, i+1):
+            if j < len(self.files) and j not in self._loading: self._loading[j] = self._pool.submit(self._cut_tiles, j)
+        for j in [j for j in self._loading if j not in (i, i+1)]: del self._loading[j]
+        return self._loading[i].result()
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._pid = None
+
+    def subset(self, files):
+        "View of the dataset for `files` that shares its tiles (without reading or tiling the images again)."
+        idxs = [self.files.index(f) for f in L(files)]
+        tiles = [t for i in idxs for t in range(*self.file_tiles[i])]
+        ds = super().subset(files)
+        keys = ['centers', 'image_shapes', 'in_slices', 'out_slices'] + ([] if self.lazy else ['tile_data', 'tile_labels', 'tile_weights'])
+        for k in keys:
+            if getattr(self, k) is not None: setattr(ds, k, [getattr(self, k)[t] for t in tiles])
+        ds.image_indices = [j for j, i in enumerate(idxs) for _ in range(*self.file_tiles[i])]
+        ends = np.cumsum([self.file_tiles[i][1]-self.file_tiles[i][0] for i in idxs]).tolist()
+        ds.file_tiles = list(zip([0]+ends[:-1], ends))
+        return ds
 
     def __len__(self):
-        return len(self.tile_data)
+        return len(self.centers)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        X = np.moveaxis(self.tile_data[idx] , -1, 0).astype('float32')
+        if self.lazy and self._slicing() and self._by_region(self.files[self.image_indices[idx]]):
+            (data, labels, weights), t = self._read_tile(idx), 0
+        elif self.lazy:
+            i = self.image_indices[idx]
+            data, labels, weights = self._lazy_tiles(i)
+            t = idx - self.file_tiles[i][0]
+        else:
+            data, labels, weights, t = self.tile_data, self.tile_labels, self.tile_weights, idx
+        X = np.moveaxis(data[t], -1, 0)
+        if not self.native_dtype: X = X.astype('float32')
 
         if self.label_fn is not None:
-            Y = self.tile_labels[idx].astype('int64')
-            W = self.tile_weights[idx].astype('float32')
+            Y = labels[t].astype('int64')
+            W = weights[t].astype('float32')
             return TensorImage(X), TensorMask(Y), W
         else:
             return TensorImage(X)
@@ -590,17 +1372,32 @@ class TileDataset(BaseDataset):
         assert isinstance(tiles, list), "You need to pass a list"
         assert len(tiles) == len(self), f"Tile list must have length{len(self)}"
 
-        out_ll = []
-        for idx in range(len(self)):
-            outIdx = self.image_indices[idx]
-            outShape = self.image_shapes[idx]
-            outSlice = self.out_slices[idx]
-            inSlice = self.in_slices[idx]
-            if len(out_ll) < outIdx + 1:
-                if len(tiles[0].shape)>2:
-                    out_ll.append(np.empty((*outShape, self.c)))
-                else:
-                    out_ll.append(np.empty(outShape))
-            out_ll[outIdx][outSlice] = tiles[idx][inSlice]
-
-        return out_ll
\ No newline at end of file
+        return [img for _, img in TileStitcher(self, dtype='float64').push(tiles)]
+
+# Cell
+class TileStitcher:
+    "Stitches tiles of a `TileDataset` (in dataset order) into per-image buffers, images are returned as soon as their last tile arrives."
+    def __init__(self, ds, dtype='float32', memmap_dir=None):
+        store_attr('ds, dtype, memmap_dir')
+        self.idx = 0
+        self.buffers = {}
+
+    def buffer_path(self, i):
+        "File of the memory-mapped buffer of image `i` in `memmap_dir`"
+        return Path(self.memmap_dir)/f'{self.ds.files[i].stem}.npy'
+
+    def _buffer(self, i, shape):
+        if self.memmap_dir is None: return np.empty(shape, dtype=self.dtype)
+        Path(self.memmap_dir).mkdir(exist_ok=True, parents=True)
+        return np.lib.format.open_memmap(self.buffer_path(i), mode='w+', dtype=self.dtype, shape=shape)
+
+    def push(self, tiles):
+        "Writes a batch of tiles (with all output channels in the last dimension) and returns finished `(image index, image)` pairs"
+        finished = []
+        for tile in tiles:
+            i = self.ds.image_indices[self.idx]
+            if i not in self.buffers: self.buffers[i] = self._buffer(i, (*self.ds.image_shapes[self.idx], *tile.shape[2:]))
+            self.buffers[i][self.ds.out_slices[self.idx]] = tile[self.ds.in_slices[self.idx]]
+            self.idx += 1
+            if self.idx == self.ds.file_tiles[i][1]: finished.append((i, self.buffers.pop(i)))
+        return finished
\ No newline at end of file
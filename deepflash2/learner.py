@@ -1,11 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/00_learner.ipynb (unless otherwise specified).
 
-__all__ = ['Config', 'energy_max', 'save_tmp', 'EnsembleLearner']
+__all__ = ['Config', 'energy_max', 'save_tmp_iter', 'save_tmp', 'EnsembleLearner']
 
 # Cell
 import shutil, gc, joblib, json, numpy as np, pandas as pd
 import torch, torch.nn as nn, torch.nn.functional as F
 from dataclasses import dataclass, field, asdict
+from functools import partial
 from pathlib import Path
 
 from sklearn import svm
@@ -29,7 +30,7 @@ from .metrics import Dice_f1, Iou
 from .losses import WeightedSoftmaxCrossEntropy
 from .callbacks import ElasticDeformCallback
 from .models import get_default_shapes
-from .data import TileDataset, RandomTileDataset, _read_img, _read_msk, calculate_weights
+from .data import TileDataset, RandomTileDataset, BatchDeformation, ScaleNormalize, ToUnitRange, TileStitcher, ImageCache, _read_img, _read_msk, _is_windowed, calculate_weights
 from .utils import iou, plot_results, get_label_fn, calc_iterations, save_mask, save_unc
 import deepflash2.tta as tta
 
@@ -57,6 +58,8 @@ class Config:
     #Train Data Settings
     c:int = 2
     il:bool = False
+    img_cache_gb:float = 2. # decoded images shared by dataloader workers and folds
+    native_dtype:bool = True # integer images in their dtype, unless their value ranges differ
 
     #Train Settings
     lr:float = 0.001
@@ -151,15 +154,34 @@ def apply_dropout(self:Learner):
 
 # Cell
 def energy_max(e, ks=20, dim=None):
-    e = torch.as_tensor(e).resize_((1,1,*e.shape))
+    e = torch.as_tensor(e).reshape((1,1,*e.shape))
     e = F.avg_pool2d(e, ks)
     return torch.max(e)
 
 # Cell
+def _stacked_tta(model, images, tfms, n_times=1, micro_batch=None):
+    "Predicts all tta variants and `n_times` repeats of `images` in forward passes of at most `micro_batch` tiles."
+    transformers = list(tta.Compose(tfms))
+    x = [t.augment_image(images) for t in transformers]
+    # Rotated non-square tiles cannot be stacked
+    if any(a.shape!=images.shape for a in x): return None
+    x = torch.cat([a for a in x for _ in range(n_times)])
+    with torch.no_grad():
+        out = torch.cat([model(chunk) for chunk in x.split(micro_batch or len(x))])
+    # All repeats of one variant are de-augmented at once
+    out = torch.cat([t.deaugment_mask(o) for t, o in zip(transformers, out.split(n_times*len(images)))])
+    return out.view(len(transformers)*n_times, len(images), *out.shape[1:])
+
+def _argmax(x, rows=1024, out=None):
+    "Row-chunked argmax over the last axis of `x` with the smallest unsigned dtype that fits (or into `out`)"
+    if out is None: out = np.empty(x.shape[:-1], dtype=np.min_scalar_type(x.shape[-1]-1))
+    for r in range(0, x.shape[0], rows): out[r:r+rows] = np.argmax(x[r:r+rows], axis=-1)
+    return out
+
 @patch
 def predict_tiles(self:Learner, ds_idx=1, dl=None, mc_dropout=False, n_times=1, use_tta=False,
-                  tta_merge='mean', energy_T=1, energy_ks=20, padding=(0,0,0,0)): #(-52,-52,-52,-52)
-    "Make predictions and reconstruct tiles, optional with dropout and/or tta applied."
+                  tta_merge='mean', energy_T=1, energy_ks=20, padding=(0,0,0,0), batch_tta=False, micro_batch=None, smx_dtype='float32', memmap_dir=None): #(-52,-52,-52,-52)
+    "Make predictions and reconstruct tiles, optional with dropout and/or tta applied. Yields `(file, smx, seg, std, energy)` as soon as all tiles of an image are predicted."
 
     if dl is None: dl = self.dls[ds_idx].new(shuffled=False, drop_last=False)
     if use_tta: tfms=[tta.HorizontalFlip(), tta.Rotate90(angles=[90,180,270])]
@@ -168,53 +190,66 @@ def predict_tiles(self:Learner, ds_idx=1, dl=None, mc_dropout=False, n_times=1,
     self.model.eval()
     if mc_dropout: self.apply_dropout()
 
-    smx_means, energy_means, stds = [], [], []
+    # Softmax, std, and energy of each tile are stitched into one float32 buffer per image (memory-mapped in `memmap_dir` for large images)
+    stitcher = TileStitcher(dl.dataset, memmap_dir=memmap_dir)
     for data in progress_bar(dl, leave=False):
         if isinstance(data, TensorImage): images = data
         else: images, _, _ = data
-        m_smx = tta.Merger()
-        m_energy = tta.Merger()
-        out_list_smx = []
-        for t in tta.Compose(tfms):
-            for _ in range(n_times):
-                aug_images = t.augment_image(images)
-                with torch.no_grad():
-                    out = self.model(aug_images)
-                out = t.deaugment_mask(out)
-                if sum(padding)>0: out = F.pad(out, padding)
-                m_smx.append(F.softmax(out, dim=1))
-                e = (energy_T*torch.logsumexp(out/energy_T, dim=1)) #negative energy score
-                m_energy.append(e)
-
-        stds.append(m_smx.result('std'))
-        smx_means.append(m_smx.result())
-        energy_means.append(m_energy.result())
-
-    softmax_pred = torch.cat(smx_means).permute(0,2,3,1)
-    smx_tiles = [x for x in softmax_pred.cpu().numpy()]
-
-    std_pred = torch.cat(stds).permute(0,2,3,1)
-    std_tiles = [x[...,0] for x in std_pred.cpu().numpy()]
-
-    energy_pred = torch.cat(energy_means)#.permute(0,2,3,1)
-    energy_tiles = [x for x in energy_pred.cpu().numpy()]
-
-    smxcores = dl.reconstruct_from_tiles(smx_tiles)
-    segmentations = [np.argmax(x, axis=-1) for x in smxcores]
-    std_deviations = dl.reconstruct_from_tiles(std_tiles)
-    energy_scores = dl.reconstruct_from_tiles(energy_tiles)
-
-    if energy_ks is not None:
-        energy_scores = [energy_max(e, energy_ks) for e in energy_scores]
-
-    return smxcores, segmentations, std_deviations, energy_scores
+        out = _stacked_tta(self.model, images, tfms, n_times, micro_batch) if batch_tta else None
+        if out is not None:
+            if sum(padding)>0: out = F.pad(out, padding)
+            smx_all = F.softmax(out, dim=2)
+            smx, std = smx_all.mean(0), smx_all.std(0)
+            energy = (energy_T*torch.logsumexp(out/energy_T, dim=2)).mean(0) #negative energy score
+        else:
+            m_smx = tta.OnlineMerger()
+            m_energy = tta.OnlineMerger()
+            for t in tta.Compose(tfms):
+                for _ in range(n_times):
+                    aug_images = t.augment_image(images)
+                    with torch.no_grad():
+                        out = self.model(aug_images)
+                    out = t.deaugment_mask(out)
+                    if sum(padding)>0: out = F.pad(out, padding)
+                    m_smx.append(F.softmax(out, dim=1))
+                    e = (energy_T*torch.logsumexp(out/energy_T, dim=1)) #negative energy score
+                    m_energy.append(e)
+            smx, std, energy = m_smx.result(), m_smx.result('std'), m_energy.result()
+
+        out = torch.cat([smx, std[:, :1], energy[:, None]], dim=1)
+        n_classes = smx.shape[1]
+        for i, img in stitcher.push(out.permute(0,2,3,1).cpu().numpy()):
+            energy = img[..., n_classes+1]
+            if energy_ks is not None: energy = energy_max(energy, energy_ks)
+            smx_img, std_img = img[..., :n_classes], img[..., n_classes]
+            # Memory-mapped results are passed on as views
+            if memmap_dir is None or img.dtype!=smx_dtype:
+                smx_img, std_img = (np.ascontiguousarray(x, dtype=smx_dtype) for x in (smx_img, std_img))
+            yield dl.dataset.files[i], smx_img, _argmax(img[..., :n_classes]), std_img, energy
+            if memmap_dir is not None:
+                del img, smx_img, std_img, energy
+                try: stitcher.buffer_path(i).unlink()
+                except OSError: pass
 
 # Cell
+def _save_result(path, **arrays):
+    "Saves `arrays` as `.npy` files in the directory `path`, to be memory-mapped by `_load_result`"
+    path.mkdir(exist_ok=True, parents=True)
+    for k, v in arrays.items(): np.save(path/f'{k}.npy', np.asarray(v))
+
+def _load_result(path, mmap_mode='r'):
+    "Memory-mapped arrays of a result saved by `_save_result`"
+    return {p.stem: np.load(p, mmap_mode=mmap_mode) for p in Path(path).glob('*.npy')}
+
+def save_tmp_iter(pth_tmp, results):
+    "Saves each `(file, smx, seg, std, enrgy)` result of `predict_tiles` to `pth_tmp/file.stem` while iterating and passes it on (nothing is saved without iterating)"
+    for f, smx, seg, std, enrgy in results:
+        _save_result(pth_tmp/f.stem, smx=smx, seg=seg, std=std, enrgy=enrgy)
+        yield f, smx, seg, std, enrgy
+
 def save_tmp(pth_tmp, files, results):
-    smxs, segs, stds, enrgys = results
-    pth_tmp.mkdir(exist_ok=True, parents=True)
-    for i, f in progress_bar(enumerate(files), total=len(files), leave=False):
-        np.savez(pth_tmp/f'{f.stem}.npz', smx=smxs[i], seg=segs[i], std=stds[i], enrgy=enrgys[i])
+    "Saves the `results` (smxs, segs, stds, enrgys) of `files`"
+    for _ in progress_bar(save_tmp_iter(pth_tmp, zip(files, *results)), total=len(files), leave=False): pass
 
 # Cell
 class EnsembleLearner(GetAttr):
@@ -249,6 +284,8 @@ class EnsembleLearner(GetAttr):
             ds_kwargs.setdefault(key, value)
         self.ds_kwargs = ds_kwargs
         self.item_tfms=[Brightness(max_lighting=self.light)]
+        self.image_cache = ImageCache(int(self.img_cache_gb*1024**3)) if self.img_cache_gb else None
+        self._store = None
         self.models = {}
         self.recorder = {}
         self._set_splits()
@@ -263,6 +300,15 @@ class EnsembleLearner(GetAttr):
         else:
             self.splits = {1: (self.files[0], self.files[0])}
 
+    def _datasets(self, n_jobs=-1, verbose=1):
+        "Training and validation datasets of all files, created once and shared by all folds (see `subset`)"
+        kwargs = dict(label_fn=self.label_fn, native_dtype=self.native_dtype, image_cache=self.image_cache, **self.mw_kwargs, **self.ds_kwargs)
+        key = repr(kwargs)
+        if self._store is None or self._store[0]!=key:
+            self._store = (key, RandomTileDataset(self.files, n_jobs=n_jobs, seed=self.random_state, verbose=verbose, **kwargs),
+                           TileDataset(self.files, n_jobs=n_jobs, verbose=verbose, **kwargs))
+        return self._store[1:]
+
     def save_model(self, file, model, pickle_protocol=2):
         state = model.state_dict()
         state = {'model': state, 'arch':self.arch, 'repo':self.repo, 'stats':self.stats, 'c':self.c}
@@ -282,10 +328,24 @@ class EnsembleLearner(GetAttr):
                 self.stats = state['stats']
         else:
             model_state = state
-        model = torch.hub.load(self.repo, self.arch, pretrained=None, n_classes=self.c, in_channels=self.in_channels, pre_ssl=False)
+        model = self._create_model(pretrained=None, n_classes=self.c, in_channels=self.in_channels, pre_ssl=False)
         model.load_state_dict(model_state, strict=strict)
         return model
 
+    def _create_model(self, **kwargs):
+        "Model `arch` from `repo`, a github repository or a local directory with a `hubconf.py`"
+        source = 'local' if Path(self.repo).is_dir() else 'github'
+        return torch.hub.load(self.repo, self.arch, source=source, **kwargs)
+
+    def _dataloaders(self, train_ds, valid_ds, bs, item_tfms=[]):
+        "Training dataloaders, augmentations of native images and with `batch_augmentation` are applied to the batch"
+        batch_tfms = [ScaleNormalize.from_stats(*self.stats, scale=train_ds.scale)]
+        # Value augmentations expect 0-1 floats, native images are scaled on the batch first
+        if train_ds.scale!=1 and item_tfms: item_tfms, batch_tfms = [], [ToUnitRange(train_ds.scale), *item_tfms, ScaleNormalize.from_stats(*self.stats)]
+        if train_ds.batch_augmentation: item_tfms, batch_tfms = [], [BatchDeformation(train_ds.padding), *item_tfms, *batch_tfms]
+        # fastai rebinds bound methods to the dataloader, the dataset is bound with `partial`
+        return DataLoaders.from_dsets(train_ds, valid_ds, bs=bs, shuffle_fn=partial(RandomTileDataset.shuffle_fn, train_ds), after_item=item_tfms, after_batch=batch_tfms)
+
     def fit(self, i, n_iter=None, lr_max=None, bs=None , n_jobs=-1, verbose=1, **kwargs):
         n_iter = n_iter or self.n_iter
         lr_max = lr_max or self.lr
@@ -293,12 +353,11 @@ class EnsembleLearner(GetAttr):
         self.stats = self.stats or self.ds.compute_stats()
         name = self.ensemble_dir/f'{self.arch}_model-{i}.pth'
         files_train, files_val = self.splits[i]
-        train_ds = RandomTileDataset(files_train, label_fn=self.label_fn, n_jobs=n_jobs, verbose=verbose, **self.mw_kwargs, **self.ds_kwargs)
-        valid_ds = TileDataset(files_val, label_fn=self.label_fn, n_jobs=n_jobs, verbose=verbose, **self.mw_kwargs,**self.ds_kwargs)
-        batch_tfms = Normalize.from_stats(*self.stats)
-        dls = DataLoaders.from_dsets(train_ds, valid_ds, bs=bs, after_item=self.item_tfms, after_batch=batch_tfms)
+        train_store, valid_store = self._datasets(n_jobs, verbose)
+        train_ds, valid_ds = train_store.subset(files_train, seed=self.random_state+i), valid_store.subset(files_val)
+        dls = self._dataloaders(train_ds, valid_ds, bs, self.item_tfms)
         pre = None if self.pretrained=='new' else self.pretrained
-        model = torch.hub.load(self.repo, self.arch, pretrained=pre, n_classes=dls.c, in_channels=self.in_channels, **kwargs)
+        model = self._create_model(pretrained=pre, n_classes=dls.c, in_channels=self.in_channels, **kwargs)
         if torch.cuda.is_available(): dls.cuda(), model.cuda()
         learn = Learner(dls, model, metrics=self.metrics, wd=self.wd, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim], cbs=self.cbs)
         learn.model_dir = self.ensemble_dir.parent/'.tmp'
@@ -327,20 +386,27 @@ class EnsembleLearner(GetAttr):
             self.models.pop(i+1, None)
         self.n = n
 
-    def predict(self, files, model_no, bs=None, **kwargs):
+    def _predict(self, files, model_no, bs=None, **kwargs):
+        "Yields and saves the results of `files` one by one"
         bs = bs or self.bs
         model_path = self.models[model_no]
         model = self.load_model(model_path)
-        batch_tfms = Normalize.from_stats(*self.stats)
-        ds = TileDataset(files, **self.ds_kwargs)
+        ds = TileDataset(files, lazy=True, native_dtype=self.native_dtype, **self.ds_kwargs)
+        batch_tfms = ScaleNormalize.from_stats(*self.stats, scale=ds.scale)
         dls = DataLoaders.from_dsets(ds, batch_size=bs, after_batch=batch_tfms, shuffle=False, drop_last=False, num_workers = 0)
         if torch.cuda.is_available(): dls.cuda(), model.cuda()
         learn = Learner(dls, model, loss_func=self.loss_fn)
         if self.mpt: learn.to_fp16()
-        results = learn.predict_tiles(dl=dls.train, **kwargs)
         pth_tmp = self.path/'.tmp'/model_path.name
-        save_tmp(pth_tmp, files, results)
-        return results
+        # Large (windowed) images are stitched in memory-mapped buffers
+        if any(_is_windowed(f) for f in files): kwargs.setdefault('memmap_dir', self.path/'.tmp'/'stitch')
+        return save_tmp_iter(pth_tmp, learn.predict_tiles(dl=dls.train, **kwargs))
+
+    def predict(self, files, model_no, bs=None, **kwargs):
+        smxs, segs, stds, enrgys = [], [], [], []
+        for _, smx, seg, std, enrgy in self._predict(files, model_no, bs, **kwargs):
+            for l, r in zip([smxs, segs, stds, enrgys], [smx, seg, std, enrgy]): l.append(r)
+        return smxs, segs, stds, enrgys
 
     def get_valid_results(self, model_no=None, save_dir=None, filetype='.png', **kwargs):
         res_list = []
@@ -354,8 +420,7 @@ class EnsembleLearner(GetAttr):
                 unc_path.mkdir(parents=True, exist_ok=True)
         for i in model_list:
             _, files_val = self.splits[i]
-            res = self.predict(files_val, i, **kwargs)
-            for j, f in enumerate(files_val):
+            for f, _, seg, std, enrgy in self._predict(files_val, i, **kwargs):
                 msk = self.ds.get_data(f, mask=True)[0]
                 m_path = self.models[i].name
                 df_tmp = pd.Series({'file' : f.name,
@@ -363,14 +428,14 @@ class EnsembleLearner(GetAttr):
                         'model_no' : i,
                         'img_path': f,
                         'msk_path': self.label_fn(f),
-                        'res_path': self.path/'.tmp'/m_path/f'{f.stem}.npz',
-                        'iou': iou(msk, res[1][j]),
-                        'energy_max': res[3][j].numpy()})
+                        'res_path': self.path/'.tmp'/m_path/f.stem,
+                        'iou': iou(msk, seg),
+                        'energy_max': enrgy.numpy()})
                 res_list.append(df_tmp)
                 if save_dir:
-                    save_mask(res[1][j], pred_path/f'{df_tmp.file}_{df_tmp.model}_mask', filetype)
+                    save_mask(seg, pred_path/f'{df_tmp.file}_{df_tmp.model}_mask', filetype)
                     if self.tta:
-                        save_unc(res[2][j], unc_path/f'{df_tmp.file}_{df_tmp.model}_unc', filetype)
+                        save_unc(std, unc_path/f'{df_tmp.file}_{df_tmp.model}_unc', filetype)
         self.df_val = pd.DataFrame(res_list)
         if save_dir: self.df_val.to_csv(save_dir/f'val_results.csv', index=False)
 
@@ -382,10 +447,8 @@ class EnsembleLearner(GetAttr):
         for _, r in df.iterrows():
             img = self.ds.get_data(r.img_path)[0]
             msk = self.ds.get_data(r.img_path, mask=True)[0]
-            with open(r.res_path, 'rb') as res:
-                tmp = np.load(res)
-                pred = tmp['seg']
-                std = tmp['std']
+            tmp = _load_result(r.res_path)
+            pred, std = np.asarray(tmp['seg']), np.asarray(tmp['std'])
             _d_model = f'Model {r.model_no}'
             if self.tta: plot_results(img, msk, pred, std, df=r, model=_d_model)
             else: plot_results(img, msk, pred, np.zeros_like(pred), df=r, model=_d_model)
@@ -401,7 +464,7 @@ class EnsembleLearner(GetAttr):
         print(f'Found {len(self.models)} models in folder {path}')
         print(self.models)
 
-    def ensemble_results(self, files, save_dir=None, filetype='.png', use_tta=None, **kwargs):
+    def ensemble_results(self, files, save_dir=None, filetype='.png', use_tta=None, rows=1024, **kwargs):
         use_tta = use_tta or self.pred_tta
         pth_out = self.path/'.tmp'/f'{self.arch}_ensemble'
         pth_out.mkdir(exist_ok=True, parents=True)
@@ -414,43 +477,48 @@ class EnsembleLearner(GetAttr):
                 unc_path.mkdir(parents=True, exist_ok=True)
         res_list = []
         for f in files:
-            for m in self.models.values():
-                pth_tmp = self.path/'.tmp'/m.name/f'{f.stem}.npz'
-                m_smx, m_std, m_enrgy = tta.Merger(), tta.Merger(), tta.Merger()
-                with open(pth_tmp, 'rb') as file:
-                    tmp = np.load(file)
-                    m_smx.append(tmp['smx'])
-                    m_std.append(tmp['std'])
-                    m_enrgy.append(tmp['enrgy'])
-            smx = m_smx.result()
-            seg = np.argmax(smx, axis=-1)
-            std = m_std.result()
+            results = [_load_result(self.path/'.tmp'/m.name/f.stem) for m in self.models.values()]
+            out = pth_out/f.stem
+            out.mkdir(exist_ok=True, parents=True)
+            smx, std = [np.lib.format.open_memmap(out/f'{k}.npy', mode='w+', dtype=results[0][k].dtype, shape=results[0][k].shape)
+                        for k in ['smx', 'std']]
+            # The memory-mapped results of the models are merged in blocks of rows
+            for r in range(0, smx.shape[0], rows):
+                m_smx, m_std = tta.OnlineMerger(), tta.OnlineMerger()
+                for res in results:
+                    m_smx.append(np.array(res['smx'][r:r+rows]))
+                    m_std.append(np.array(res['std'][r:r+rows]))
+                smx[r:r+rows], std[r:r+rows] = m_smx.result().numpy(), m_std.result().numpy()
+            seg = _argmax(smx, rows, out=np.lib.format.open_memmap(out/'seg.npy', mode='w+', dtype=np.min_scalar_type(smx.shape[-1]-1), shape=smx.shape[:-1]))
+            m_enrgy = tta.OnlineMerger()
+            for res in results: m_enrgy.append(np.array(res['enrgy']))
             enrgy = m_enrgy.result()
-            np.savez(pth_out/f'{f.stem}.npz', smx=smx, seg=seg, std=std, enrgy=enrgy)
+            np.save(out/'enrgy.npy', enrgy.numpy())
+            for a in [smx, seg, std]: a.flush()
             df_tmp = pd.Series({'file' : f.name,
                                 'model' :  pth_out.name,
                                 'img_path': f,
-                                'res_path': pth_out/f'{f.stem}.npz',
+                                'res_path': out,
                                 'energy_max': enrgy.numpy()})
             res_list.append(df_tmp)
             if save_dir:
-                save_mask(seg.numpy(), pred_path/f'{df_tmp.file}_{df_tmp.model}_mask', filetype)
+                save_mask(np.asarray(seg), pred_path/f'{df_tmp.file}_{df_tmp.model}_mask', filetype)
                 if use_tta:
-                    save_unc(std.numpy(), unc_path/f'{df_tmp.file}_{df_tmp.model}_unc', filetype)
+                    save_unc(np.asarray(std), unc_path/f'{df_tmp.file}_{df_tmp.model}_unc', filetype)
+            del results, smx, seg, std
         return pd.DataFrame(res_list)
 
     def get_ensemble_results(self, new_files, save_dir=None, filetype='.png', **kwargs):
         res_list = []
         for i in self.models:
-            res = self.predict(new_files, i, **kwargs)
-            for j, f in enumerate(new_files):
+            for f, *_, enrgy in self._predict(new_files, i, **kwargs):
                 m_path = self.models[i].name
                 df_tmp = pd.Series({'file' : f.name,
                                     'model_no': i,
                                     'model' :  m_path,
                                     'img_path': f,
-                                    'res_path': self.path/'.tmp'/m_path/f'{f.stem}.npz',
-                                    'energy_max': res[3][j].numpy()})
+                                    'res_path': self.path/'.tmp'/m_path/f.stem,
+                                    'energy_max': enrgy.numpy()})
                 res_list.append(df_tmp)
         self.df_models = pd.DataFrame(res_list)
         self.df_ens  = self.ensemble_results(new_files, save_dir=save_dir, filetype=filetype, **kwargs)
@@ -462,20 +530,19 @@ class EnsembleLearner(GetAttr):
         if files is not None: df = df.set_index('file', drop=False).loc[files]
         for _, r in df.iterrows():
             img = _read_img(r.img_path)
-            with open(r.res_path, 'rb') as res:
-                tmp = np.load(res)
-                pred = tmp['seg']
-                std = tmp['std']
+            tmp = _load_result(r.res_path)
+            pred, std = np.asarray(tmp['seg']), np.asarray(tmp['std'])
             if unc: plot_results(img, pred, std, df=r, unc_metric=unc_metric)
             else: plot_results(img, pred, df=r)
 
     def lr_find(self, files=None, bs=None, n_jobs=-1, verbose=1, **kwargs):
         bs = bs or self.bs
         files = files or self.files
-        train_ds = RandomTileDataset(files, label_fn=self.label_fn, n_jobs=n_jobs, verbose=verbose, **self.mw_kwargs, **self.ds_kwargs)
-        dls = DataLoaders.from_dsets(train_ds,train_ds, bs=bs)
+        self.stats = self.stats or self.ds.compute_stats()
+        train_ds = self._datasets(n_jobs, verbose)[0].subset(files, seed=self.random_state)
+        dls = self._dataloaders(train_ds, train_ds, bs)
         pre = None if self.pretrained=='new' else self.pretrained
-        model = torch.hub.load(self.repo, self.arch, pretrained=pre, n_classes=dls.c, in_channels=self.in_channels)
+        model = self._create_model(pretrained=pre, n_classes=dls.c, in_channels=self.in_channels)
         if torch.cuda.is_available(): dls.cuda(), model.cuda()
         learn = Learner(dls, model, metrics=self.metrics, wd=self.wd, loss_func=self.loss_fn, opt_func=_optim_dict[self.optim])
         if self.mpt: learn.to_fp16()
@@ -488,7 +555,7 @@ class EnsembleLearner(GetAttr):
             print(self.mw_kwargs)
             print(f'Calculating weights. Please wait...')
             msk = _read_msk(m)
-            _, w, _ = calculate_weights(msk, n_dims=self.c, **self.mw_kwargs)
+            _, w, _ = calculate_weights(msk, n_dims=self.c, cache_dir=self.ds.preproc_dir, **self.mw_kwargs)
             fig, axes = plt.subplots(nrows=1, ncols=2, figsize=figsize, **kwargs)
             axes[0].imshow(msk)
             axes[0].set_axis_off()
@@ -530,10 +597,10 @@ add_docs(EnsembleLearner, "Meta class to train and predict model ensembles with
          load_model="Load `model` from `file` along with `arch`, `stats`, and `c` classes",
          fit="Fit model number `i`",
          fit_ensemble="Fit `i` models and `skip` existing",
-         predict="Predict `files` with model at `model_path`",
+         predict="Predict `files` with model `model_no`, save the results in '.tmp' and return them as (smxs, segs, stds, enrgys)",
          get_valid_results="Validate models on validation data and save results",
          show_valid_results="Plot results of all or `file` validation images",
-         ensemble_results="Merge single model results",
+         ensemble_results="Merge single model results from memory-maps, in blocks of `rows`",
          get_ensemble_results="Get models and ensemble results",
          show_ensemble_results="Show result of ensemble or `model_no`",
          get_models="Get models saved at `path`",
@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/07_tta.ipynb (unless otherwise specified).
 
-__all__ = ['rot90', 'hflip', 'vflip', 'BaseTransform', 'Chain', 'Transformer', 'Compose', 'Merger', 'HorizontalFlip',
-           'VerticalFlip', 'Rotate90']
+__all__ = ['rot90', 'hflip', 'vflip', 'BaseTransform', 'Chain', 'Transformer', 'Compose', 'Merger', 'OnlineMerger',
+           'HorizontalFlip', 'VerticalFlip', 'Rotate90']
 
 # Cell
 import torch
@@ -85,6 +85,47 @@ class Merger:
             raise ValueError('Not correct merge type `{}`.'.format(self.type))
         return result
 
+# Cell
+def _entropy(p, dim):
+    "Shannon entropy of probabilities `p` along `dim`"
+    return -(p*torch.log(p.clamp_min(1e-12))).sum(dim)
+
+class OnlineMerger:
+    "Merges appended outputs in place (Welford) with constant memory, entropy and mutual information need the class `dim`"
+    def __init__(self, dim=None):
+        self.dim, self.n = dim, 0
+
+    def append(self, x):
+        x = torch.as_tensor(x)
+        if not x.is_floating_point(): x = x.float()
+        self.n += 1
+        if self.n == 1:
+            self.mean, self.max, self.m2 = x.clone(), x.clone(), torch.zeros_like(x)
+            if self.dim is not None: self.mean_entropy = _entropy(x, self.dim)
+            return
+        delta = x - self.mean
+        self.mean.add_(delta, alpha=1/self.n)
+        self.m2.addcmul_(delta, x - self.mean)
+        torch.max(self.max, x, out=self.max)
+        if self.dim is not None: self.mean_entropy.add_(_entropy(x, self.dim) - self.mean_entropy, alpha=1/self.n)
+
+    def result(self, type='mean'):
+        if self.n == 0: raise ValueError('Nothing to merge, `append` outputs first.')
+        if type == 'max':
+            result = self.max.clone()
+        elif type == 'mean':
+            result = self.mean.clone()
+        elif type == 'std':
+            # Unbiased like `torch.std`
+            result = torch.sqrt(self.m2/(self.n-1))
+        elif type in ['entropy', 'mutual_information']:
+            if self.dim is None: raise ValueError(f'Merge type `{type}` requires the class `dim`.')
+            result = _entropy(self.mean, self.dim)
+            if type == 'mutual_information': result = result - self.mean_entropy
+        else:
+            raise ValueError('Not correct merge type `{}`.'.format(type))
+        return result
+
 # Cell
 class HorizontalFlip(BaseTransform):
     "Flip images horizontally (left->right)"